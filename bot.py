@@ -1,5 +1,13 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import io
 import logging
 import os
+import sys
+import threading
+import time
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 
@@ -23,6 +31,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Diagnóstico de rendimiento: solo los IDs listados pueden usar /perfil y /lentos
+ADMIN_IDS = [int(x) for x in os.environ.get('ADMIN_USER_IDS', '').split(',') if x.strip()]
+LENTO_UMBRAL_MS = float(os.environ.get('LENTO_UMBRAL_MS', '500'))
+LENTOS_MAX = int(os.environ.get('LENTOS_MAX', '20'))
+PERFIL_INTERVALO = 0.005  # segundos entre muestras
+PERFIL_MAX_SEGUNDOS = 120
+
+NOMBRES_ESTADO = {
+    RIESGO: 'RIESGO',
+    STOP_LOSS: 'STOP_LOSS',
+    RATIO: 'RATIO',
+    PREGUNTA_PATRON: 'PREGUNTA_PATRON',
+    PATRON: 'PATRON',
+    TIMEFRAME: 'TIMEFRAME',
+    CONFIG_CAPITAL: 'CONFIG_CAPITAL',
+    CONFIG_APALANCAMIENTO: 'CONFIG_APALANCAMIENTO',
+    ConversationHandler.END: 'END',
+}
+
 # Base de datos simple en memoria (en producción usarías una BD real)
 user_capital_db = {}
 user_leverage_db = {}
@@ -90,6 +117,157 @@ class RiskCalculator:
 
 calculator = RiskCalculator()
 
+class PerfiladorMuestreo:
+    """Muestrea la pila del hilo del bucle de eventos mientras está activo"""
+    def __init__(self, intervalo=PERFIL_INTERVALO):
+        self.intervalo = intervalo
+        # Lo actualizan los callbacks instrumentados; el hilo muestreador solo lo lee
+        self.handler_actual = None
+        self.pilas = collections.Counter()
+        self._hilo = None
+        self._hilo_objetivo = None
+        self._detener = threading.Event()
+        # Se activa al detener la aplicación para no bloquear el apagado esperando el perfil
+        self.fin = None
+        self.inicio = None
+    
+    @property
+    def activo(self):
+        return self._hilo is not None
+    
+    def iniciar(self):
+        """Arranca el muestreo del hilo actual (debe llamarse desde el bucle de eventos)"""
+        if self.activo:
+            return False
+        self.pilas = collections.Counter()
+        self._hilo_objetivo = threading.get_ident()
+        self._detener.clear()
+        self.fin = asyncio.Event()
+        self.inicio = time.monotonic()
+        self._hilo = threading.Thread(target=self._muestrear, name='perfilador', daemon=True)
+        self._hilo.start()
+        return True
+    
+    def detener(self):
+        """Detiene el muestreo y devuelve las pilas acumuladas"""
+        if self.activo:
+            self._detener.set()
+            self._hilo.join()
+            self._hilo = None
+        return self.pilas
+    
+    def _muestrear(self):
+        while not self._detener.wait(self.intervalo):
+            frame = sys._current_frames().get(self._hilo_objetivo)
+            pila = []
+            while frame is not None:
+                code = frame.f_code
+                pila.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            # La raíz de cada pila es el handler en ejecución para poder agregar por handler
+            pila.append(self.handler_actual or '(bucle)')
+            pila.reverse()
+            self.pilas[';'.join(pila)] += 1
+
+class RegistroLentos:
+    """Buffer circular con los últimos updates que superan el umbral de latencia"""
+    def __init__(self, umbral_ms=LENTO_UMBRAL_MS, maximo=LENTOS_MAX):
+        self.umbral_ms = umbral_ms
+        self.registros = collections.deque(maxlen=maximo)
+    
+    def registrar(self, medicion):
+        if medicion['total_ms'] >= self.umbral_ms:
+            self.registros.append(medicion)
+
+class ColaMedida(asyncio.Queue):
+    """Cola de updates que anota cuándo se encola cada uno"""
+    def __init__(self):
+        super().__init__()
+        self.encolado = {}
+    
+    def put_nowait(self, item):
+        if isinstance(item, Update):
+            self.encolado[id(item)] = time.perf_counter()
+        super().put_nowait(item)
+
+perfilador = PerfiladorMuestreo()
+registro_lentos = RegistroLentos()
+_medicion_actual = contextvars.ContextVar('medicion_actual', default=None)
+
+def instrumentar_callback(callback, estado):
+    """Envuelve un callback para medir su duración y anotar handler y estado"""
+    @functools.wraps(callback)
+    async def envoltura(update, context):
+        medicion = _medicion_actual.get()
+        # La atribución supone concurrent_updates=False (un update a la vez)
+        perfilador.handler_actual = callback.__name__
+        inicio = time.perf_counter()
+        inicio_cpu = time.thread_time()
+        nuevo_estado = None
+        try:
+            nuevo_estado = await callback(update, context)
+            return nuevo_estado
+        except BaseException:
+            nuevo_estado = 'error'
+            raise
+        finally:
+            perfilador.handler_actual = None
+            if medicion is not None:
+                medicion['handlers'].append({
+                    'handler': callback.__name__,
+                    'estado': estado,
+                    # None significa que la conversación sigue en el mismo estado
+                    'nuevo_estado': estado if nuevo_estado is None else NOMBRES_ESTADO.get(nuevo_estado, nuevo_estado),
+                    'handler_ms': (time.perf_counter() - inicio) * 1000,
+                    'cpu_ms': (time.thread_time() - inicio_cpu) * 1000,
+                })
+    return envoltura
+
+def instrumentar_handler(handler, estado=None):
+    """Instrumenta un handler, recorriendo los handlers internos de las conversaciones"""
+    if isinstance(handler, ConversationHandler):
+        for h in handler.entry_points:
+            instrumentar_handler(h, 'entrada')
+        for clave, handlers in handler.states.items():
+            for h in handlers:
+                instrumentar_handler(h, NOMBRES_ESTADO.get(clave, clave))
+        for h in handler.fallbacks:
+            instrumentar_handler(h, 'fallback')
+    else:
+        handler.callback = instrumentar_callback(handler.callback, estado)
+
+class AplicacionPerfilada(Application):
+    """Application que mide cada update y guarda los lentos en registro_lentos"""
+    def add_handler(self, handler, group=0):
+        instrumentar_handler(handler)
+        super().add_handler(handler, group)
+    
+    async def process_update(self, update):
+        inicio = time.perf_counter()
+        encolado = None
+        if isinstance(self.update_queue, ColaMedida):
+            encolado = self.update_queue.encolado.pop(id(update), None)
+        medicion = {
+            'hora': time.time(),
+            'usuario': update.effective_user.id if isinstance(update, Update) and update.effective_user else None,
+            'cola_ms': (inicio - encolado) * 1000 if encolado is not None else 0,
+            'handlers': [],
+        }
+        token = _medicion_actual.set(medicion)
+        try:
+            await super().process_update(update)
+        finally:
+            _medicion_actual.reset(token)
+            medicion['proceso_ms'] = (time.perf_counter() - inicio) * 1000
+            medicion['total_ms'] = medicion['cola_ms'] + medicion['proceso_ms']
+            registro_lentos.registrar(medicion)
+    
+    async def stop(self):
+        # stop() espera a las tareas de create_task: cortar antes el perfil en curso
+        if perfilador.activo:
+            perfilador.fin.set()
+        await super().stop()
+
 def get_user_capital(user_id):
     """Obtiene el capital configurado del usuario"""
     return user_capital_db.get(user_id)
@@ -562,6 +740,96 @@ async def leverage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     return CONFIG_APALANCAMIENTO
 
+async def perfil_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Perfila el bot durante N segundos y envía las pilas en formato collapsed"""
+    try:
+        segundos = float(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("❌ Uso: /perfil [segundos]")
+        return
+    
+    if not 1 <= segundos <= PERFIL_MAX_SEGUNDOS:
+        await update.message.reply_text(f"❌ La duración debe estar entre 1 y {PERFIL_MAX_SEGUNDOS} segundos")
+        return
+    
+    if not perfilador.iniciar():
+        await update.message.reply_text("⚠️ Ya hay un perfilado en curso")
+        return
+    
+    await update.message.reply_text(f"🔬 Perfilando durante {segundos:g} s...")
+    context.application.create_task(enviar_perfil(context.bot, update.effective_chat.id, segundos))
+
+async def enviar_perfil(bot, chat_id, segundos):
+    """Espera a que termine el perfilado y envía el resultado como documento"""
+    interrumpido = False
+    try:
+        await asyncio.wait_for(perfilador.fin.wait(), segundos)
+        interrumpido = True
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        duracion = time.monotonic() - perfilador.inicio
+        pilas = perfilador.detener()
+    
+    total = sum(pilas.values())
+    if not total:
+        await bot.send_message(chat_id, "⚠️ No se tomaron muestras")
+        return
+    
+    por_handler = collections.Counter()
+    for pila, muestras in pilas.items():
+        por_handler[pila.split(';', 1)[0]] += muestras
+    
+    resumen = f"🔬 {total} muestras en {duracion:.1f} s"
+    resumen += " (interrumpido al detener el bot)\n" if interrumpido else "\n"
+    for handler, muestras in por_handler.most_common(8):
+        resumen += f"• {handler}: {muestras * 100 / total:.1f}%\n"
+    
+    contenido = '\n'.join(f"{pila} {muestras}" for pila, muestras in pilas.items())
+    await bot.send_document(
+        chat_id,
+        document=io.BytesIO(contenido.encode('utf-8')),
+        filename=time.strftime('perfil-%Y%m%d-%H%M%S.folded'),
+        caption=resumen
+    )
+
+async def lentos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra los últimos updates que superaron el umbral de latencia"""
+    registros = list(registro_lentos.registros)
+    if not registros:
+        await update.message.reply_text(f"✅ Sin updates lentos (umbral {registro_lentos.umbral_ms:.0f} ms)")
+        return
+    
+    lineas = [f"🐢 Últimos {len(registros)} updates > {registro_lentos.umbral_ms:.0f} ms"]
+    for medicion in reversed(registros):
+        lineas.append("")
+        lineas.append(
+            f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(medicion['hora']))} · "
+            f"{medicion['total_ms']:.0f} ms · usuario {medicion['usuario']}"
+        )
+        lineas.append(f"  cola {medicion['cola_ms']:.0f} ms · proceso {medicion['proceso_ms']:.0f} ms")
+        handler_ms = 0
+        for h in medicion['handlers']:
+            handler_ms += h['handler_ms']
+            # Solo los handlers de una conversación tienen estado
+            transicion = f" [{h['estado']} → {h['nuevo_estado']}]" if h['estado'] is not None else ""
+            lineas.append(
+                f"  {h['handler']}{transicion} "
+                f"{h['handler_ms']:.0f} ms (CPU del hilo {h['cpu_ms']:.0f} ms, "
+                f"espera {max(h['handler_ms'] - h['cpu_ms'], 0):.0f} ms)"
+            )
+        lineas.append(f"  despacho {medicion['proceso_ms'] - handler_ms:.0f} ms")
+    texto = '\n'.join(lineas)
+    
+    # Telegram limita los mensajes a 4096 caracteres
+    if len(texto) > 4000:
+        await update.message.reply_document(
+            document=io.BytesIO(texto.encode('utf-8')),
+            filename=time.strftime('lentos-%Y%m%d-%H%M%S.txt')
+        )
+    else:
+        await update.message.reply_text(texto)
+
 # Función para manejo de errores
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
@@ -579,7 +847,13 @@ def main():
         if not TOKEN:
             raise ValueError("TOKEN de Telegram no configurado")
         
-        application = Application.builder().token(TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TOKEN)
+            .application_class(AplicacionPerfilada)
+            .update_queue(ColaMedida())
+            .build()
+        )
         
         # Handler de errores
         application.add_error_handler(error_handler)
@@ -634,6 +908,11 @@ def main():
         application.add_handler(config_leverage_handler)
         application.add_handler(calc_handler)
         
+        # Diagnóstico de rendimiento (solo administradores)
+        solo_admin = filters.User(user_id=ADMIN_IDS)
+        application.add_handler(CommandHandler("perfil", perfil_command, filters=solo_admin))
+        application.add_handler(CommandHandler("lentos", lentos_command, filters=solo_admin))
+        
         print("🚀 Bot iniciado correctamente...")
         print("📡 Esperando mensajes...")
         